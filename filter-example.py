@@ -3,11 +3,24 @@
 # All it does is change the name of the commit's author.
 # It could do other things, including modifying the
 # channels list
+#
+# It works in all three ways irkerhook.py can use a filter:
+# run once per commit with the metadata as its argument, run once
+# per push reading metadata a line at a time (filterstream = true),
+# or called in-process (filtercmd = python:/path/to/filter-example.py:oz).
 # 
 import sys, json
-metadata = json.loads(sys.argv[1])
 
-metadata['author'] = "The Great and Powerful Oz"
+def oz(metadata):
+    metadata['author'] = "The Great and Powerful Oz"
+    return metadata
 
-print json.dumps(metadata)
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        print json.dumps(oz(json.loads(sys.argv[1])))
+    else:
+        # Each answer must be flushed, or the hook will wait for it.
+        for line in iter(sys.stdin.readline, ''):
+            sys.stdout.write(json.dumps(oz(json.loads(line))) + "\n")
+            sys.stdout.flush()
 # end
@@ -3,7 +3,7 @@
 # Distributed under BSD terms.
 #
 # This script contains git porcelain and porcelain byproducts.
-# Requires Python 2.6, or 2.5 with the simplejson library installed.
+# Requires Python 2.6 or later.
 #
 # usage: irkerhook.py [-V] [-n] [--variable=value...] [commit_id...]
 #
@@ -33,13 +33,26 @@ urlprefixmap = {
 # By default, ship to the freenode #commits list
 default_channels = "irc://chat.freenode.net/#commits"
 
+# How long a streaming filter (see filterstream) may take over one commit.
+filter_timeout = 30
+
+# Web views are checked and tinyified several at a time.  Each HTTP
+# request gets url_timeout seconds, and all of them together get
+# url_deadline; a URL that isn't ready by then is left off the
+# notification.  Tinyified URLs are remembered in the repository.
+url_timeout = 5
+url_deadline = 20
+url_workers = 8
+url_cache_size = 1000
+
 #
 # No user-serviceable parts below this line:
 #
 
 version = "2.13"
 
-import os, sys, commands, socket, urllib, subprocess, locale, datetime, re
+import os, sys, commands, socket, subprocess, locale, datetime, re
+import select, time, imp, threading, urllib2, httplib, Queue
 from pipes import quote as shellquote
 try:
     import simplejson as json	# Faster, also makes us Python-2.5-compatible
@@ -49,6 +62,19 @@ except ImportError:
 def do(command):
     return unicode(commands.getstatusoutput(command)[1], locale.getlocale()[1] or 'UTF-8').encode(locale.getlocale()[1] or 'UTF-8')
 
+def pipe(command, data=""):
+    "Run a command (an argument list) on some input; None if it fails."
+    try:
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=open(os.devnull, "w"))
+    except OSError:
+        return None
+    output = proc.communicate(data)[0]
+    if proc.returncode != 0:
+        return None
+    return output
+
 class Commit:
     def __init__(self, extractor, commit):
         "Per-commit data."
@@ -63,37 +89,25 @@ class Commit:
         self.author_date = None
         self.commit_date = None
         self.__dict__.update(extractor.__dict__)
+        # The extractor's batch of commit data is not metadata.
+        self.__dict__.pop("prefetched", None)
+    def webview(self):
+        "Return the URL of this commit's web view, if there is one."
+        if self.urlprefix.lower() == "none":
+            return None
+        urlprefix = urlprefixmap.get(self.urlprefix, self.urlprefix)
+        return (urlprefix % self.__dict__) + self.commit
     def __unicode__(self):
         "Produce a notification string from this commit."
-        if self.urlprefix.lower() == "none":
-            self.url = ""
-        else:
-            urlprefix = urlprefixmap.get(self.urlprefix, self.urlprefix)
-            webview = (urlprefix % self.__dict__) + self.commit
-            try:
-                if urllib.urlopen(webview).getcode() == 404:
-                    raise IOError
-                if self.tinyifier and self.tinyifier.lower() != "none":
-                    try:
-                        # Didn't get a retrieval error or 404 on the web
-                        # view, so try to tinyify a reference to it.
-                        self.url = open(urllib.urlretrieve(self.tinyifier + webview)[0]).read()
-                        try:
-                            self.url = self.url.decode('UTF-8')
-                        except UnicodeError:
-                            pass
-                    except IOError:
-                        self.url = webview
-                else:
-                    self.url = webview
-            except IOError:
-                self.url = ""
+        # ship() normally has the URL looked up beforehand.
+        if self.url is None:
+            self.url = UrlResolver(self.tinyifier).lookup(self.webview())
         res = self.template % self.__dict__
         return unicode(res, 'UTF-8') if not isinstance(res, unicode) else res
 
 class GenericExtractor:
     "Generic class for encapsulating data from a VCS."
-    booleans = ["tcp"]
+    booleans = ["tcp", "batch", "filterstream"]
     numerics = ["maxchannels"]
     strings = ["email"]
     def __init__(self, arguments):
@@ -103,6 +117,7 @@ class GenericExtractor:
         # These aren't really repo data but they belong here anyway...
         self.email = None
         self.tcp = True
+        self.batch = False
         self.tinyifier = default_tinyifier
         self.server = None
         self.channels = None
@@ -112,6 +127,7 @@ class GenericExtractor:
         self.host = socket.getfqdn()
         self.cialike = None
         self.filtercmd = None
+        self.filterstream = False
         # Color highlighting is disabled by default.
         self.color = None
         self.bold = self.green = self.blue = self.yellow = ""
@@ -171,6 +187,12 @@ class GenericExtractor:
             if variable == "maxchannels":
                 return
             setattr(self, variable, value)
+    def prefetch(self, commit_ids):
+        "Gather data for many commits at once, where the VCS makes that cheap."
+        pass
+    def url_cache(self):
+        "Where to remember tinyified URLs, if anywhere."
+        return None
     def do_overrides(self):
         "Make command-line overrides possible."
         for tok in self.arguments:
@@ -208,6 +230,29 @@ def has(dirname, paths):
 
 # VCS-dependent code begins here
 
+def git_config():
+    "Read all of git's configuration in one go."
+    config = {}
+    # With -z, each entry is the key, a newline, and the value; a key
+    # with no newline after it was set without a value, meaning true.
+    for entry in (pipe(["git", "config", "--list", "-z"]) or "").split("\0"):
+        if "\n" in entry:
+            (key, value) = entry.split("\n", 1)
+        else:
+            (key, value) = (entry, "true")
+        if key:
+            config[key] = value
+    return config
+
+def git_bool(value):
+    "Canonicalize a boolean the way git config --bool does."
+    if value is None:
+        return ""
+    elif value.lower() in ("true", "yes", "on") \
+             or (value.isdigit() and int(value)):
+        return "true"
+    return "false"
+
 class GitExtractor(GenericExtractor):
     "Metadata extraction for the git version control system."
     @staticmethod
@@ -218,24 +263,29 @@ class GitExtractor(GenericExtractor):
     def __init__(self, arguments):
         GenericExtractor.__init__(self, arguments)
         # Get all global config variables
-        self.project = do("git config --get irker.project")
-        self.repo = do("git config --get irker.repo")
-        self.server = do("git config --get irker.server")
-        self.channels = do("git config --get irker.channels")
-        self.email = do("git config --get irker.email")
-        self.tcp = do("git config --bool --get irker.tcp")
+        config = git_config()
+        get = lambda name: config.get(name, "")
+        self.project = get("irker.project")
+        self.repo = get("irker.repo")
+        self.server = get("irker.server")
+        self.channels = get("irker.channels")
+        self.email = get("irker.email")
+        self.tcp = git_bool(config.get("irker.tcp"))
+        self.batch = git_bool(config.get("irker.batch"))
         self.template = '%(bold)s%(project)s:%(reset)s %(green)s%(author)s%(reset)s %(repo)s:%(yellow)s%(branch)s%(reset)s * %(bold)s%(rev)s%(reset)s / %(bold)s%(files)s%(reset)s: %(logmsg)s %(brown)s%(url)s%(reset)s'
-        self.tinyifier = do("git config --get irker.tinyifier") or default_tinyifier
-        self.color = do("git config --get irker.color")
-        self.urlprefix = do("git config --get irker.urlprefix") or "gitweb"
-        self.cialike = do("git config --get irker.cialike")
-        self.filtercmd = do("git config --get irker.filtercmd")
+        self.tinyifier = get("irker.tinyifier") or default_tinyifier
+        self.color = get("irker.color")
+        self.urlprefix = get("irker.urlprefix") or "gitweb"
+        self.cialike = get("irker.cialike")
+        self.filtercmd = get("irker.filtercmd")
+        self.filterstream = git_bool(config.get("irker.filterstream"))
         # These are git-specific
         self.refname = do("git symbolic-ref HEAD 2>/dev/null")
-        self.revformat = do("git config --get irker.revformat")
+        self.revformat = get("irker.revformat")
+        self.prefetched = {}
         # The project variable defaults to the name of the repository toplevel.
         if not self.project:
-            bare = do("git config --bool --get core.bare")
+            bare = git_bool(config.get("core.bare"))
             if bare.lower() == "true":
                 keyfile = "HEAD"
             else:
@@ -256,34 +306,101 @@ class GitExtractor(GenericExtractor):
     def head(self):
         "Return a symbolic reference to the tip commit of the current branch."
         return "HEAD"
+    def url_cache(self):
+        "Remember tinyified URLs in the git directory."
+        gitdir = os.environ.get("GIT_DIR") or do("git rev-parse --git-dir")
+        return os.path.join(gitdir, "irker-urls.json")
+    def prefetch(self, commit_ids):
+        "Extract data for a batch of commits in a few git runs, not four each."
+        # Whatever this fails to find, commit_factory() asks git for
+        # one commit at a time, as it always did.
+        names = [x for x in commit_ids if "\n" not in x]
+        found = pipe(["git", "cat-file", "--batch-check"],
+                     "".join(x + "^{commit}\n" for x in names))
+        if found is None:
+            return
+        ids = {}
+        for (name, line) in zip(names, found.splitlines()):
+            fields = line.split()
+            if len(fields) == 3 and fields[1] == "commit":
+                ids[name] = fields[0]
+        shas = []
+        for sha in ids.values():
+            if sha not in shas:
+                shas.append(sha)
+        if not shas:
+            return
+        data = dict((sha, {}) for sha in shas)
+        # One log run for the people, dates and summaries...
+        log = pipe(["git", "log", "--no-walk=unsorted", "--stdin", "-z",
+                    "--pretty=format:%H%n%an%n%ae%n%s%n%ai|%ci"],
+                   "".join(sha + "\n" for sha in shas))
+        for record in (log or "").split("\0"):
+            fields = record.split("\n")
+            if len(fields) == 5 and fields[0] in data:
+                data[fields[0]]["log"] = fields[1:]
+        # ...one diff-tree run for the file lists, in which each
+        # commit's files follow a line with its ID...
+        tree = pipe(["git", "diff-tree", "-r", "--name-only", "--always",
+                     "--stdin"], "".join(sha + "\n" for sha in shas))
+        if tree is not None:
+            pending = list(shas)
+            files = None
+            for line in tree.splitlines():
+                if pending and line == pending[0]:
+                    files = data[pending.pop(0)]["files"] = []
+                elif files is not None:
+                    files.append(line)
+        # ...and describe runs for the revision names.  With --always,
+        # git falls back to an abbreviated ID rather than failing.
+        if self.revformat not in ('raw', 'short'):
+            for i in range(0, len(shas), 100):
+                chunk = shas[i:i+100]
+                described = pipe(["git", "describe", "--always"] + chunk)
+                if described is None:
+                    continue
+                for (sha, rev) in zip(chunk, described.splitlines()):
+                    data[sha]["rev"] = "" if sha.startswith(rev) else rev
+        for (name, sha) in ids.items():
+            self.prefetched[name] = data[sha]
     def commit_factory(self, commit_id):
         "Make a Commit object holding data for a specified commit ID."
         commit = Commit(self, commit_id)
         commit.branch = re.sub(r"^refs/[^/]*/", "", self.refname)
+        prefetched = self.prefetched.get(commit_id, {})
         # Compute a description for the revision
         if self.revformat == 'raw':
             commit.rev = commit.commit
         elif self.revformat == 'short':
             commit.rev = ''
+        elif "rev" in prefetched:
+            commit.rev = prefetched["rev"]
         else: # self.revformat == 'describe'
             commit.rev = do("git describe %s 2>/dev/null" % shellquote(commit.commit))
         if not commit.rev:
             commit.rev = commit.commit[:12]
         # Extract the meta-information for the commit
-        commit.files = do("git diff-tree -r --name-only " + shellquote(commit.commit))
-        commit.files = " ".join(commit.files.strip().split("\n")[1:])
+        if "files" in prefetched:
+            commit.files = " ".join(prefetched["files"])
+        else:
+            commit.files = do("git diff-tree -r --name-only " + shellquote(commit.commit))
+            commit.files = " ".join(commit.files.strip().split("\n")[1:])
         # Design choice: for git we ship only the first message line, which is
         # conventionally supposed to be a summary of the commit.  Under
         # other VCSes a different choice may be appropriate.
-        commit.author_name, commit.mail, commit.logmsg = \
-            do("git log -1 '--pretty=format:%an%n%ae%n%s' " + shellquote(commit.commit)).split("\n")
+        if "log" in prefetched:
+            (commit.author_name, commit.mail, commit.logmsg, dates) = \
+                prefetched["log"]
+        else:
+            commit.author_name, commit.mail, commit.logmsg = \
+                do("git log -1 '--pretty=format:%an%n%ae%n%s' " + shellquote(commit.commit)).split("\n")
+            dates = do("git log -1 '--pretty=format:%ai|%ci' " + shellquote(commit.commit))
         # This discards the part of the author's address after @.
         # Might be be nice to ship the full email address, if not
         # for spammers' address harvesters - getting this wrong
         # would make the freenode #commits channel into harvester heaven.
         commit.author = commit.mail.split("@")[0]
-        commit.author_date, commit.commit_date = \
-            do("git log -1 '--pretty=format:%ai|%ci' " + shellquote(commit.commit)).split("|")
+        commit.author_date, commit.commit_date = dates.split("|")
         return commit
 
 class SvnExtractor(GenericExtractor):
@@ -357,6 +474,7 @@ class HgExtractor(GenericExtractor):
         self.channels = ui.config('irker', 'channels')
         self.email = ui.config('irker', 'email')
         self.tcp = str(ui.configbool('irker', 'tcp'))  # converted to bool again in do_overrides
+        self.batch = str(ui.configbool('irker', 'batch'))
         self.template = '%(bold)s%(project)s:%(reset)s %(green)s%(author)s%(reset)s %(repo)s:%(yellow)s%(branch)s%(reset)s * %(bold)s%(rev)s%(reset)s / %(bold)s%(files)s%(reset)s: %(logmsg)s %(brown)s%(url)s%(reset)s'
         self.tinyifier = ui.config('irker', 'tinyifier') or default_tinyifier
         self.color = ui.config('irker', 'color')
@@ -367,12 +485,16 @@ class HgExtractor(GenericExtractor):
             self.urlprefix = self.urlprefix.rstrip('/') + '/rev/'
         self.cialike = ui.config('irker', 'cialike')
         self.filtercmd = ui.config('irker', 'filtercmd')
+        self.filterstream = str(ui.configbool('irker', 'filterstream'))
         if not self.project:
             self.project = os.path.basename(self.repository.root.rstrip('/'))
         self.do_overrides()
     def head(self):
         "Return a symbolic reference to the tip commit of the current branch."
         return "-1"
+    def url_cache(self):
+        "Remember tinyified URLs in the .hg directory."
+        return os.path.join(self.repository.path, "irker-urls.json")
     def commit_factory(self, commit_id):
         "Make a Commit object holding data for a specified commit ID."
         from mercurial.node import short
@@ -398,15 +520,23 @@ def hg_hook(ui, repo, **kwds):
     # [hooks]
     # incoming.irker = python:/path/to/irkerhook.py:hg_hook
     extractor = HgExtractor([(ui, repo)])
+    courier = Courier(extractor, False)
+    metafilter = MetadataFilter(extractor)
+    resolver = UrlResolver(extractor.tinyifier, extractor.url_cache())
     start = repo[kwds['node']].rev()
     end = len(repo)
     if start != end:
         # changegroup with multiple commits, so we generate a notification
         # for each one
-        for rev in range(start, end):
-            ship(extractor, rev, False)
+        metadata = filter_all(extractor, range(start, end), metafilter)
+        resolver.start([m.webview() for m in metadata])
     else:
-        ship(extractor, kwds['node'], False)
+        metadata = filter_all(extractor, [kwds['node']], metafilter)
+    for m in metadata:
+        ship(extractor, m, False, courier, resolver)
+    resolver.close()
+    metafilter.close()
+    courier.close()
 
 # The files we use to identify a Subversion repo might occur as content
 # in a git or hg repo, but the special subdirectories for those are more
@@ -415,20 +545,326 @@ extractors = [GitExtractor, HgExtractor, SvnExtractor]
 
 # VCS-dependent code ends here
 
-def ship(extractor, commit, debug):
-    "Ship a notification for the specified commit."
-    metadata = extractor.commit_factory(commit)
+class Courier:
+    "Carry notifications to irkerd, over one connection for the whole run."
+    def __init__(self, extractor, debug):
+        self.extractor = extractor
+        self.debug = debug
+        self.sock = None
+        self.smtp = None
+        self.batch = []
+    def send(self, message, channels):
+        "Send a JSON request, or save it up if batching."
+        if self.debug:
+            print message
+        elif channels:
+            if self.extractor.batch and self.extractor.tcp \
+                   and not self.extractor.email:
+                self.batch.append(message)
+            else:
+                self.deliver(message)
+    def deliver(self, message):
+        "Pass a request on, connecting first if need be."
+        extractor = self.extractor
+        try:
+            if extractor.email:
+                # We can't really figure out what our SF username is without
+                # exploring our environment. The mail pipeline doesn't care
+                # about who sent the mail, other than being from sourceforge.
+                # A better way might be to simply call mail(1)
+                sender = "irker@users.sourceforge.net"
+                msg = """From: %(sender)s
+Subject: irker json
 
-    # This is where we apply filtering
-    if extractor.filtercmd:
-        cmd = '%s %s' % (shellquote(extractor.filtercmd),
-                         shellquote(json.dumps(metadata.__dict__)))
-        data = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
+%(message)s""" % {"sender":sender, "message":message}
+                if self.smtp is None:
+                    import smtplib
+                    self.smtp = smtplib.SMTP()
+                    self.smtp.connect()
+                self.smtp.sendmail(sender, extractor.email, msg)
+            elif extractor.tcp:
+                if self.sock is None:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    try:
+                        sock.connect((extractor.server or default_server, IRKER_PORT))
+                    except socket.error:
+                        sock.close()
+                        raise
+                    self.sock = sock
+                self.sock.sendall(message + "\n")
+            else:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.sock.sendto(message + "\n", (extractor.server or default_server, IRKER_PORT))
+        except socket.error, e:
+            sys.stderr.write("%s\n" % e)
+            # Start afresh with the next message.
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+    def close(self):
+        "Send whatever batch has been saved up, and hang up."
+        if self.batch:
+            # irkerd takes a JSON list of requests as a batch.
+            self.deliver("[" + ",".join(self.batch) + "]")
+            self.batch = []
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.smtp is not None:
+            self.smtp.quit()
+            self.smtp = None
+
+class UrlResolver:
+    "Check and tinyify commit web-view URLs, several at a time."
+    def __init__(self, tinyifier, cache_file=None):
+        if not tinyifier or tinyifier.lower() == "none":
+            tinyifier = None
+        self.tinyifier = tinyifier
+        self.cache_file = cache_file
+        self.cache = {}	# Tinyifier request -> [answer, time]
+        if cache_file and tinyifier:
+            try:
+                self.cache = json.load(open(cache_file))
+            except (IOError, ValueError):
+                pass
+        self.dirty = False
+        self.results = {}
+        self.done = {}	# Web view -> Event set when its result is in
+        self.todo = Queue.Queue()
+        self.workers = 0
+        self.deadline = None
+        self.lock = threading.Lock()
+    def cached(self, webview):
+        "Return the remembered tinyified URL for a web view, or None."
+        if not self.tinyifier:
+            return None
+        with self.lock:
+            entry = self.cache.get(self.tinyifier + webview)
+        return entry and entry[0]
+    def start(self, webviews):
+        "Begin looking up web views in the background."
+        if self.deadline is None:
+            self.deadline = time.time() + url_deadline
+        for webview in webviews:
+            if not webview or webview in self.done \
+                   or self.cached(webview) is not None:
+                continue
+            self.done[webview] = threading.Event()
+            self.todo.put(webview)
+            with self.lock:
+                if self.workers >= url_workers:
+                    continue
+                self.workers += 1
+            worker = threading.Thread(target=self.work)
+            # Don't let a hung server keep the hook from exiting.
+            worker.setDaemon(True)
+            worker.start()
+    def work(self):
+        "Look up web views until there are no more."
+        while True:
+            with self.lock:
+                try:
+                    webview = self.todo.get_nowait()
+                except Queue.Empty:
+                    self.workers -= 1
+                    return
+            result = self.resolve(webview)
+            with self.lock:
+                self.results[webview] = result
+            self.done[webview].set()
+    def resolve(self, webview):
+        "Check that a web view exists, and tinyify its URL if we can."
+        try:
+            try:
+                urllib2.urlopen(webview, timeout=url_timeout).close()
+            except urllib2.HTTPError, e:
+                # Only a 404 means the commit isn't there.
+                if e.code == 404:
+                    return ""
+        except (IOError, ValueError, httplib.HTTPException):
+            return ""
+        if not self.tinyifier:
+            return webview
+        try:
+            # Didn't get a retrieval error or 404 on the web
+            # view, so try to tinyify a reference to it.
+            url = urllib2.urlopen(self.tinyifier + webview,
+                                  timeout=url_timeout).read()
+        except (IOError, ValueError, httplib.HTTPException):
+            return webview
+        try:
+            url = url.decode('UTF-8')
+        except UnicodeError:
+            pass
+        with self.lock:
+            self.cache[self.tinyifier + webview] = [url, time.time()]
+            self.dirty = True
+        return url
+    def lookup(self, webview):
+        "Return the URL to show for a web view, waiting for it if need be."
+        if not webview:
+            return ""
+        url = self.cached(webview)
+        if url is not None:
+            return url
+        self.start([webview])
+        self.done[webview].wait(max(0, self.deadline - time.time()))
+        with self.lock:
+            return self.results.get(webview, "")
+    def close(self):
+        "Save newly tinyified URLs for next time."
+        if not (self.dirty and self.cache_file):
+            return
+        with self.lock:
+            entries = sorted(self.cache.items(), key=lambda x: x[1][1])
+        cache = dict(entries[-url_cache_size:])
+        try:
+            tmp = self.cache_file + ".tmp"
+            fp = open(tmp, "w")
+            json.dump(cache, fp)
+            fp.close()
+            os.rename(tmp, self.cache_file)
+        except (IOError, OSError):
+            pass
+
+class MetadataFilter:
+    "Pass commit metadata through the user's filter, if there is one."
+    # A filtercmd of the form python:/path/to/file.py:function names a
+    # function that is called in-process with the metadata dictionary,
+    # and returns it altered (or alters it in place and returns None).
+    # Otherwise filtercmd is a program.  By default it is run once per
+    # commit with the metadata as its argument.  With filterstream set,
+    # it is started once and kept running, reading one line of JSON
+    # metadata at a time from standard input and answering each with a
+    # line of JSON on standard output.
+    def __init__(self, extractor):
+        self.command = extractor.filtercmd
+        self.stream = extractor.filterstream
+        self.function = None
+        self.process = None
+        self.pending = ""
+        if self.command and self.command.startswith("python:"):
+            (path, _, name) = self.command[7:].rpartition(":")
+            try:
+                module = imp.load_source("irker_filter", path)
+                self.function = getattr(module, name)
+            except (IOError, ImportError, AttributeError, SyntaxError), e:
+                sys.stderr.write("irkerhook.py: can't load filter %s: %s\n"
+                                 % (self.command, e))
+                raise SystemExit(1)
+    def apply(self, metadata):
+        "Return the filter's version of a metadata dictionary."
+        if self.function:
+            result = self.function(metadata)
+            if result is None:
+                result = metadata
+            return result
+        elif self.stream:
+            data = self.converse(json.dumps(metadata))
+        else:
+            cmd = '%s %s' % (shellquote(self.command),
+                             shellquote(json.dumps(metadata)))
+            data = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
         try:
-            metadata.__dict__.update(json.loads(data))
+            return json.loads(data)
         except ValueError:
             sys.stderr.write("irkerhook.py: could not decode JSON: %s\n" % data)
             raise SystemExit(1)
+    def converse(self, request):
+        "Send a line to the filter coprocess and return its answer."
+        if self.process is None:
+            try:
+                self.process = subprocess.Popen([self.command],
+                                                stdin=subprocess.PIPE,
+                                                stdout=subprocess.PIPE)
+            except OSError, e:
+                self.fail("can't run filter %s: %s" % (self.command, e))
+        try:
+            self.process.stdin.write(request + "\n")
+            self.process.stdin.flush()
+        except IOError, e:
+            self.fail("can't write to filter: %s" % e)
+        deadline = time.time() + filter_timeout
+        fd = self.process.stdout.fileno()
+        while "\n" not in self.pending:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                self.fail("filter took more than %d seconds" % filter_timeout)
+            data = os.read(fd, 65536)
+            if not data:
+                self.fail("filter exited")
+            self.pending += data
+        (line, self.pending) = self.pending.split("\n", 1)
+        return line
+    def fail(self, complaint):
+        "Give up on the filter coprocess."
+        sys.stderr.write("irkerhook.py: %s\n" % complaint)
+        if self.process is not None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        self.process = None
+        raise SystemExit(1)
+    def close(self):
+        "Shut down the coprocess, if there is one."
+        if self.process is None:
+            return
+        (process, self.process) = (self.process, None)
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+        # End of input is the signal to stop; one that doesn't take
+        # the hint is killed.
+        deadline = time.time() + filter_timeout
+        while process.poll() is None:
+            if time.time() > deadline:
+                process.kill()
+                process.wait()
+                break
+            time.sleep(0.05)
+
+def filtered(extractor, commit, metafilter=None):
+    "Return the metadata for the specified commit, as the filter leaves it."
+    metadata = extractor.commit_factory(commit)
+
+    # This is where we apply filtering
+    if extractor.filtercmd:
+        if metafilter is None:
+            alone = MetadataFilter(extractor)
+            metadata.__dict__.update(alone.apply(metadata.__dict__))
+            alone.close()
+        else:
+            metadata.__dict__.update(metafilter.apply(metadata.__dict__))
+    return metadata
+
+def filter_all(extractor, commits, metafilter):
+    "Return filtered metadata for each commit that can be described."
+    # One bad revision (an unknown ID, or a filter that chokes on it)
+    # shouldn't cost the rest of the push its notifications.
+    described = []
+    for commit in commits:
+        try:
+            described.append(filtered(extractor, commit, metafilter))
+        except SystemExit:
+            # The filter has already said what went wrong.
+            sys.stderr.write("irkerhook.py: skipping %s\n" % commit)
+        except Exception, e:
+            sys.stderr.write("irkerhook.py: skipping %s: %s\n" % (commit, e))
+    return described
+
+def ship(extractor, metadata, debug, courier=None, resolver=None):
+    "Ship a notification for a commit's filtered metadata."
+    # Look up the web view once, however many times the message gets
+    # formatted below.
+    if resolver is None:
+        alone = UrlResolver(metadata.tinyifier, extractor.url_cache())
+        metadata.url = alone.lookup(metadata.webview())
+        alone.close()
+    else:
+        metadata.url = resolver.lookup(metadata.webview())
 
     # Rewrite the file list if too long. The objective here is only
     # to be easier on the eyes.
@@ -461,40 +897,12 @@ def ship(extractor, commit, debug):
 
     # Ready to ship.
     message = json.dumps({"to": channels, "privmsg": privmsg})
-    if debug:
-        print message
-    elif channels:
-        try:
-            if extractor.email:
-                # We can't really figure out what our SF username is without
-                # exploring our environment. The mail pipeline doesn't care
-                # about who sent the mail, other than being from sourceforge.
-                # A better way might be to simply call mail(1)
-                sender = "irker@users.sourceforge.net"
-                msg = """From: %(sender)s
-Subject: irker json
-
-%(message)s""" % {"sender":sender, "message":message}
-                import smtplib
-                smtp = smtplib.SMTP()
-                smtp.connect()
-                smtp.sendmail(sender, extractor.email, msg)
-                smtp.quit()
-            elif extractor.tcp:
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.connect((extractor.server or default_server, IRKER_PORT))
-                    sock.sendall(message + "\n")
-                finally:
-                    sock.close()
-            else:
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    sock.sendto(message + "\n", (extractor.server or default_server, IRKER_PORT))
-                finally:
-                    sock.close()
-        except socket.error, e:
-            sys.stderr.write("%s\n" % e)
+    if courier is None:
+        alone = Courier(extractor, debug)
+        alone.send(message, channels)
+        alone.close()
+    else:
+        courier.send(message, channels)
 
 if __name__ == "__main__":
     notify = True
@@ -524,7 +932,22 @@ if __name__ == "__main__":
     # And apply it.
     if not commits:
         commits = [extractor.head()]
-    for commit in commits:
-        ship(extractor, commit, not notify)
+    extractor.prefetch(commits)
+    courier = Courier(extractor, not notify)
+    metafilter = MetadataFilter(extractor)
+    resolver = UrlResolver(extractor.tinyifier, extractor.url_cache())
+    # Filter everything first, so the web views looked up are the
+    # ones the messages will use.
+    metadata = filter_all(extractor, commits, metafilter)
+    if len(metadata) > 1:
+        # Get all the web-view lookups going at once.
+        resolver.start([m.webview() for m in metadata])
+    for m in metadata:
+        ship(extractor, m, not notify, courier, resolver)
+    resolver.close()
+    metafilter.close()
+    courier.close()
+    if len(metadata) < len(commits):
+        raise SystemExit(1)
 
 #End